@@ -1,8 +1,17 @@
+import hashlib
+import threading
+from functools import partial
+
+import anyio
+import cachetools
+import msgspec
+from anyio import to_thread
 from fastapi import APIRouter, Request, HTTPException
-from pydantic import BaseModel
-from typing import Any, Dict, Optional
+from typing import Any, Dict, Optional, Tuple
 from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
+from googleapiclient.discovery import Resource, build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from googleapiclient.errors import HttpError
 import json
 
 from src import session
@@ -12,44 +21,127 @@ router = APIRouter(tags=["api"])
 
 COOKIE_NAME = "das_state"
 
+# ブロッキングな googleapiclient / sorter 呼び出しを逃がすスレッド数の上限。
+# CapacityLimiter はイベントループ起動後でないと作れないため遅延生成。
+_drive_limiter = None
+
+# Cookie→(Credentials, Drive service) の短命キャッシュ。
+# discovery の build() はスキーマJSONのパースだけで数ms〜数十msかかるので、
+# 連続リクエストでは再利用する。TTLを短くして失効・取り消しには追従させる。
+_cred_cache: "cachetools.TTLCache[bytes, Tuple[Credentials, Resource]]" = cachetools.TTLCache(
+    maxsize=10000, ttl=45
+)
+_cred_cache_lock = threading.Lock()
+
+# セッション毎の Drive service はクレデンシャル寿命に合わせて長めに持つ。
+# 45秒の _cred_cache が切れても、service の組み立て直しはこちらで吸収する。
+_service_cache: "cachetools.TTLCache[bytes, Resource]" = cachetools.TTLCache(maxsize=2000, ttl=3300)
+
+# discovery ドキュメント（~1MBのJSON）はプロセスで1回だけパースする
+_discovery_doc: Optional[dict] = None
+
+
+def _build_drive_service(creds: Credentials) -> Resource:
+    global _discovery_doc
+    if _discovery_doc is None:
+        _discovery_doc = json.loads(get_static_doc("drive", "v3"))
+    return build_from_document(_discovery_doc, credentials=creds)
+
+
+def _limiter() -> anyio.CapacityLimiter:
+    global _drive_limiter
+    if _drive_limiter is None:
+        _drive_limiter = anyio.CapacityLimiter(64)
+    return _drive_limiter
+
+
+async def _run_blocking(func, *args, **kwargs):
+    """Drive API など同期I/Oをイベントループ外のスレッドで実行する。"""
+    return await to_thread.run_sync(partial(func, *args, **kwargs), limiter=_limiter())
+
+
+def _cache_key(state: str) -> bytes:
+    return hashlib.sha256(state.encode()).digest()[:16]
 
-def _get_creds_from_request(request: Request) -> Credentials:
+
+def _invalidate_creds(state: str):
+    with _cred_cache_lock:
+        _cred_cache.pop(_cache_key(state), None)
+        _service_cache.pop(_cache_key(state), None)
+
+
+async def _get_creds_and_service(request: Request) -> Tuple[Credentials, Resource]:
     state = request.cookies.get(COOKIE_NAME)
     if not state:
         raise HTTPException(status_code=401, detail="missing auth cookie")
-    creds_json = session.creds_load(state)
+
+    key = _cache_key(state)
+    with _cred_cache_lock:
+        cached = _cred_cache.get(key)
+    if cached is not None:
+        return cached
+
+    creds_json = await session.creds_load(state)
     if not creds_json:
         raise HTTPException(status_code=401, detail="not authorized")
-    return Credentials.from_authorized_user_info(json.loads(creds_json))
+    creds = Credentials.from_authorized_user_info(json.loads(creds_json))
+
+    with _cred_cache_lock:
+        service = _service_cache.get(key)
+    if service is None:
+        service = await _run_blocking(_build_drive_service, creds)
+
+    with _cred_cache_lock:
+        _cred_cache[key] = (creds, service)
+        _service_cache[key] = service
+    return creds, service
 
 
 @router.get("/token")
-def token(request: Request) -> Dict[str, Any]:
-    _ = _get_creds_from_request(request)
+async def token(request: Request) -> Dict[str, Any]:
+    _ = await _get_creds_and_service(request)
     return {"ok": True}
 
 
-class SortBody(BaseModel):
+class SortBody(msgspec.Struct):
+    # pydanticより桁違いに軽いmsgspecでバリデーションする
     parent_id: str
-    mode: Optional[str] = "simple"  # "simple" | "ai"
-    max_files: Optional[int] = 100
-    text_max: Optional[int] = 500
+    mode: str = "simple"  # "simple" | "ai"
+    max_files: int = 100
+    text_max: int = 500
+
+
+_sort_body_decoder = msgspec.json.Decoder(SortBody)
 
 
 @router.post("/sort")
-def sort_files(body: SortBody, request: Request):
-    creds = _get_creds_from_request(request)
-    service = build("drive", "v3", credentials=creds, cache_discovery=False)
-
-    if (body.mode or "simple").lower() == "ai":
-        moved, skipped = sorter.ai_sort_files(
-            service,
-            body.parent_id,
-            text_max=body.text_max or 500,
-            max_files=body.max_files or 100,
-        )
-    else:
-        moved, skipped = sorter.sort_files_by_subfolder_name(service, body.parent_id)
+async def sort_files(request: Request):
+    try:
+        body = _sort_body_decoder.decode(await request.body())
+    except (msgspec.DecodeError, msgspec.ValidationError) as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    _, service = await _get_creds_and_service(request)
+
+    try:
+        if (body.mode or "simple").lower() == "ai":
+            moved, skipped = await _run_blocking(
+                sorter.ai_sort_files,
+                service,
+                body.parent_id,
+                text_max=body.text_max or 500,
+                max_files=body.max_files or 100,
+            )
+        else:
+            moved, skipped = await _run_blocking(
+                sorter.sort_files_by_subfolder_name, service, body.parent_id
+            )
+    except HttpError as e:
+        # トークン失効/取り消し時はキャッシュを破棄して再ログインさせる
+        if e.resp.status == 401:
+            _invalidate_creds(request.cookies.get(COOKIE_NAME, ""))
+            raise HTTPException(status_code=401, detail="google auth expired")
+        raise
 
     return {
         "status": "ok",
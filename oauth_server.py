@@ -1,31 +1,56 @@
-import os, json, base64, time
+import os, json, secrets, threading, time
+from contextlib import asynccontextmanager
+
+try:
+    # uvicorn の --loop uvloop を忘れても C 実装のループに乗るようにしておく
+    import uvloop
+    uvloop.install()
+except ImportError:  # pragma: no cover
+    pass
+from datetime import datetime, timedelta
+import httpx
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import RedirectResponse, PlainTextResponse
+from fastapi.responses import ORJSONResponse, RedirectResponse, PlainTextResponse
 from starlette.middleware.trustedhost import TrustedHostMiddleware
 from google_auth_oauthlib.flow import Flow
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 
-app = FastAPI()
+# セッション/クレデンシャル保存の共通モジュール（Redisバックエンド）
+from src import session
+from src.category_rules import load_category_profiles
 
-from fastapi import FastAPI
-from fastapi.middleware.cors import CORSMiddleware
+# Google への外向きHTTPは1つの長命クライアントを全リクエストで共有する。
+# TLSハンドシェイクを使い回すため lifespan で生成し、終了時にクローズする。
+HTTP_CLIENT: httpx.AsyncClient | None = None
 
-app = FastAPI()
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=[
-        "https://ui.gfcdapp.com",
-        "https://*.gfcdapp.com",
-    ],
-    allow_credentials=True,
-    allow_methods=["GET", "POST", "OPTIONS"],
-    allow_headers=["*"],
-)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global HTTP_CLIENT
+    HTTP_CLIENT = httpx.AsyncClient(
+        http2=True,
+        timeout=10.0,
+        limits=httpx.Limits(max_keepalive_connections=100, max_connections=200),
+    )
+    app.state.http = HTTP_CLIENT
+    await session.startup()
+    # 初回リクエストでルールJSONの読み込みを踏まないよう先に温めておく
+    load_category_profiles()
+    # 抽出用プロセスプールの起動（fork + fitz/pytesseract の子プロセス側import）は
+    # 数秒かかるので、イベントループを塞がずバックグラウンドで先に温める
+    threading.Thread(target=_warm_workers, daemon=True).start()
+    yield
+    await HTTP_CLIENT.aclose()
+    HTTP_CLIENT = None
+    await session.shutdown()
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["https://ui.gfcdapp.com"],
+    # *.gfcdapp.com のワイルドカードは allow_origins では効かないので正規表現で
+    allow_origin_regex=r"^https://([a-z0-9-]+\.)*gfcdapp\.com$",
     allow_credentials=True,           # Cookie を跨いで使うので必須
     allow_methods=["GET", "POST", "OPTIONS"],
     allow_headers=["*"],
@@ -37,8 +62,20 @@ app.add_middleware(
     allowed_hosts=["drive.gfcdapp.com", "localhost", "127.0.0.1", "*.gfcdapp.com"]
 )
 
+# /api/sort の moved/skipped は繰り返しの多いJSONなので圧縮が効く
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
+def _warm_workers():  # pragma: no cover - 起動時の先読みのみ
+    try:
+        from src.sorter import warm_extract_pool
+        warm_extract_pool()
+    except Exception as e:
+        print("extractor warmup failed:", e)
+
+
 BASE_URL = os.environ.get("BASE_URL", "http://127.0.0.1:8000").rstrip("/")
 REDIRECT_URI = f"{BASE_URL}/oauth2callback"
+TOKEN_URI = "https://oauth2.googleapis.com/token"
 SCOPES = [
     "https://www.googleapis.com/auth/drive",
     "https://www.googleapis.com/auth/drive.readonly",
@@ -53,16 +90,13 @@ COOKIE_SECURE   = True
 COOKIE_SAMESITE = "none"
 COOKIE_PATH     = "/"
 
-# セッション/クレデンシャル保存の共通モジュール
-from src import session
-
 # 既存の state ヘルパは session に置き換え
 
-def save_state(key, payload):
-    session.state_set(key, payload)
+async def save_state(key, payload):
+    await session.state_set(key, payload)
 
-def load_state(key):
-    return session.state_get(key)
+async def load_state(key):
+    return await session.state_get(key)
 
 def new_flow():
     client_config = {
@@ -70,19 +104,44 @@ def new_flow():
             "client_id": os.environ["GOOGLE_CLIENT_ID"],
             "client_secret": os.environ["GOOGLE_CLIENT_SECRET"],
             "auth_uri": "https://accounts.google.com/o/oauth2/auth",
-            "token_uri": "https://oauth2.googleapis.com/token",
+            "token_uri": TOKEN_URI,
         }
     }
     flow = Flow.from_client_config(client_config, scopes=SCOPES, redirect_uri=REDIRECT_URI)
     flow.redirect_uri = REDIRECT_URI  # 明示・念のため
     return flow
 
+async def exchange_code(code: str) -> dict:
+    """認可コードをトークンへ交換する（flow.fetch_token の非同期版）。"""
+    resp = await HTTP_CLIENT.post(TOKEN_URI, data={
+        "code": code,
+        "client_id": os.environ["GOOGLE_CLIENT_ID"],
+        "client_secret": os.environ["GOOGLE_CLIENT_SECRET"],
+        "redirect_uri": REDIRECT_URI,
+        "grant_type": "authorization_code",
+    })
+    resp.raise_for_status()
+    return resp.json()
+
+def token_response_to_creds_json(tok: dict) -> str:
+    """トークンレスポンスを Credentials.from_authorized_user_info 互換のJSONへ。"""
+    expiry = datetime.utcnow() + timedelta(seconds=int(tok.get("expires_in", 3600)))
+    return json.dumps({
+        "token": tok["access_token"],
+        "refresh_token": tok.get("refresh_token"),
+        "token_uri": TOKEN_URI,
+        "client_id": os.environ["GOOGLE_CLIENT_ID"],
+        "client_secret": os.environ["GOOGLE_CLIENT_SECRET"],
+        "scopes": tok.get("scope", "").split(),
+        "expiry": expiry.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+    })
+
 @app.get("/healthz")
-def healthz():
+async def healthz():
     return PlainTextResponse("ok")
 
 @app.get("/login")
-def login(next: str = "https://ui.gfcdapp.com/?authed=1"):
+async def login(next: str = "https://ui.gfcdapp.com/?authed=1"):
     flow = new_flow()
     auth_url, google_state = flow.authorization_url(
 
@@ -90,13 +149,10 @@ def login(next: str = "https://ui.gfcdapp.com/?authed=1"):
         include_granted_scopes="true",
         prompt="consent",
     )
-    local_state = base64.urlsafe_b64encode(json.dumps({
-        "google_state": google_state,
-        "next": next,
-        "iat": int(time.time())
-    }).encode()).decode().rstrip("=")
+    # ペイロードはRedis側にしか置かないので、Cookie値は乱数トークンで十分
+    local_state = secrets.token_urlsafe(16)
 
-    save_state(local_state, {"google_state": google_state, "next": next, "iat": int(time.time())})
+    await save_state(local_state, {"google_state": google_state, "next": next, "iat": int(time.time())})
 
     resp = RedirectResponse(url=auth_url, status_code=307)
     resp.set_cookie(
@@ -108,37 +164,35 @@ def login(next: str = "https://ui.gfcdapp.com/?authed=1"):
     return resp
 
 @app.get("/oauth2callback")
-def oauth2callback(request: Request, state: str = "", code: str = ""):
+async def oauth2callback(request: Request, state: str = "", code: str = ""):
     cookie_state = request.cookies.get(COOKIE_NAME)
     if not cookie_state:
         raise HTTPException(status_code=400, detail="missing state cookie")
 
-    rec = load_state(cookie_state)
+    rec = await load_state(cookie_state)
     if not rec:
         raise HTTPException(status_code=400, detail="state not found")
 
     if state != rec.get("google_state"):
         raise HTTPException(status_code=400, detail="state mismatch")
 
-    flow = new_flow()
     try:
-        flow.fetch_token(code=code)
+        tok = await exchange_code(code)
     except Exception as e:
-        from fastapi.responses import PlainTextResponse
         return PlainTextResponse(f"fetch_token error: {type(e).__name__}: {e}", status_code=400)
-    
-    print("CALLBACK OK: state=", state) 
-    
+
+    print("CALLBACK OK: state=", state)
+
     # クレデンシャルを保存
     try:
-        creds_json = flow.credentials.to_json()
-        session.creds_save(cookie_state, creds_json)
+        creds_json = token_response_to_creds_json(tok)
+        await session.creds_save(cookie_state, creds_json)
     except Exception as e:
         print("failed to save credentials:", e)
-    
+
     # 後片付け（リプレイ対策）
-    save_state(cookie_state, {"used": True, "at": int(time.time())})
-    
+    await save_state(cookie_state, {"used": True, "at": int(time.time())})
+
     nxt = rec.get("next") or "https://ui.gfcdapp.com/?authed=1"
     return RedirectResponse(url=nxt, status_code=302)
 
@@ -1,17 +1,112 @@
 from __future__ import annotations
 
+import json
 import os
-from typing import Any, Dict, Iterable, List
+import random
+import re
+import time
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
 try:
-    from openai import OpenAI  # type: ignore[import]
+    from openai import OpenAI, RateLimitError  # type: ignore[import]
 except ImportError as exc:  # pragma: no cover - library availability check
     raise ImportError(
         "The openai package must be installed. Ensure requirements are installed with openai>=1.0.0."
     ) from exc
 
+try:
+    import ahocorasick  # type: ignore[import]
+except ImportError:  # pragma: no cover - optional speedup
+    ahocorasick = None
+
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
+# 内容ベースの分類は高精度モデル、タイトルだけの振り分けは軽量モデルで十分
+_CONTENT_MODEL = os.getenv("DAS_CONTENT_MODEL", "gpt-5")
+_TITLE_MODEL = os.getenv("DAS_TITLE_MODEL", "gpt-4o-mini")
+
+# 429 の指数バックオフ。並列度を上げるとレート制限を踏みやすくなるので
+# 即エラーにせず少し待って引き直す
+_RETRY_MAX_TRIES = 3
+_RETRY_BASE_WAIT = 1.0
+
+
+def _chat_completion(**kwargs):
+    for attempt in range(_RETRY_MAX_TRIES):
+        try:
+            return client.chat.completions.create(**kwargs)
+        except RateLimitError:
+            if attempt == _RETRY_MAX_TRIES - 1:
+                raise
+            time.sleep(_RETRY_BASE_WAIT * (2 ** attempt) + random.uniform(0, 0.5))
+
+
+def _profiles_fingerprint(profiles: Iterable[Dict[str, Any]]) -> Tuple[Tuple[str, Tuple[str, ...]], ...]:
+    """キーワードマッチャのキャッシュキーになる不変のフィンガープリント。"""
+    rows = []
+    for profile in profiles:
+        keywords = tuple(sorted({kw.lower() for kw in (profile.get("include") or []) if kw}))
+        if keywords:
+            rows.append((profile.get("name", ""), keywords))
+    return tuple(rows)
+
+
+@lru_cache(maxsize=32)
+def _keyword_matcher(fingerprint: Tuple[Tuple[str, Tuple[str, ...]], ...]):
+    """include キーワード全体から1つのマルチパターンマッチャを構築する。
+
+    pyahocorasick があれば O(len(text)) のオートマトン、なければ
+    re の alternation にフォールバックする。値は同じキーワードを持つ
+    フォルダ名の集合（曖昧判定に使う）。
+    """
+    owners: Dict[str, set] = {}
+    for name, keywords in fingerprint:
+        for kw in keywords:
+            owners.setdefault(kw, set()).add(name)
+
+    if ahocorasick is not None:
+        automaton = ahocorasick.Automaton()
+        for kw, names in owners.items():
+            automaton.add_word(kw, frozenset(names))
+        automaton.make_automaton()
+        return ("ac", automaton)
+
+    parts = list(owners.items())
+    rx = re.compile("|".join(f"({re.escape(kw)})" for kw, _ in parts))
+    return ("re", (rx, [names for _, names in parts]))
+
+
+def match_include_keywords(subject: str, profiles: Iterable[Dict[str, Any]]) -> Optional[str]:
+    """subject が include キーワードで一意にフォルダを指すならその名前を返す。
+
+    1フォルダだけがヒットした場合のみ確定。複数フォルダに跨る・ヒットなしは
+    None を返して LLM に回す。
+    """
+    fingerprint = _profiles_fingerprint(profiles)
+    if not fingerprint:
+        return None
+    kind, matcher = _keyword_matcher(fingerprint)
+    subject_lower = subject.lower()
+
+    hit_names: set = set()
+    if kind == "ac":
+        for _, names in matcher.iter(subject_lower):
+            hit_names |= names
+    else:
+        rx, group_names = matcher
+        for m in rx.finditer(subject_lower):
+            hit_names |= group_names[m.lastindex - 1]
+
+    if len(hit_names) == 1:
+        return next(iter(hit_names))
+    return None
+
+
+def render_profiles_prompt(profiles: Iterable[Dict[str, Any]]) -> str:
+    """プロンプトに埋め込む候補フォルダ一覧。1回のソート実行で使い回せる。"""
+    return _fold_profiles_for_prompt(profiles)
+
 
 def _fold_profiles_for_prompt(profiles: Iterable[Dict[str, Any]]) -> str:
     rows: List[str] = []
@@ -29,30 +124,42 @@ def _fold_profiles_for_prompt(profiles: Iterable[Dict[str, Any]]) -> str:
     return "\n".join(rows)
 
 
-def classify_with_ai(file_name: str, text: str, folder_profiles: List[Dict[str, Any]]) -> str:
-    """ファイル内容を用いて最適なフォルダ名を決定する。"""
+def classify_with_ai(file_name: str, text: str, folder_profiles: List[Dict[str, Any]], *, joined: Optional[str] = None) -> str:
+    """ファイル内容を用いて最適なフォルダ名を決定する。
+
+    joined に render_profiles_prompt の結果を渡すと候補一覧の再構築を省ける。
+    """
 
     if not folder_profiles:
         return ""
 
-    joined = _fold_profiles_for_prompt(folder_profiles)
+    # キーワードが一意にフォルダを指すならLLMを呼ばずに確定させる
+    hit = match_include_keywords(f"{file_name}\n{text}", folder_profiles)
+    if hit:
+        return hit
+
+    if joined is None:
+        joined = _fold_profiles_for_prompt(folder_profiles)
+    # 静的な指示+候補一覧を先頭、可変のファイル名/内容を末尾に置くと
+    # OpenAI側のプロンプトキャッシュが効いて入力トークン課金が下がる
     prompt = f"""
     あなたは書類の分類アシスタントです。
-    以下の情報から、このファイルを分類する最も適切なフォルダ名を1つ選んでください。
+    以下の候補から、ファイルを分類する最も適切なフォルダ名を1つ選んでください。
 
-    - ファイル名: {file_name}
-    - 利用可能なフォルダ候補:
+    利用可能なフォルダ候補:
     {joined}
-    - ファイル内容（必要に応じて参照してください）:
-    {text}
 
     出力は候補フォルダ名のいずれかをそのまま1行だけ返してください。
     説明や要約、追加の文章は付けないでください。
     適切なフォルダが特定できない場合は "NONE" とだけ返してください。
+
+    - ファイル名: {file_name}
+    - ファイル内容（必要に応じて参照してください）:
+    {text}
     """
 
-    resp = client.chat.completions.create(
-        model="gpt-5",
+    resp = _chat_completion(
+        model=_CONTENT_MODEL,
         messages=[{"role": "user", "content": prompt}],
         max_tokens=20,
         temperature=0,
@@ -60,30 +167,127 @@ def classify_with_ai(file_name: str, text: str, folder_profiles: List[Dict[str,
     return resp.choices[0].message.content.strip()
 
 
-def classify_title_with_ai(file_name: str, folder_profiles: List[Dict[str, Any]]) -> str:
+def classify_title_with_ai(file_name: str, folder_profiles: List[Dict[str, Any]], *, joined: Optional[str] = None) -> str:
     """タイトルと候補カテゴリから最適なカテゴリ名を返す。"""
 
     if not folder_profiles:
         return ""
 
-    joined = _fold_profiles_for_prompt(folder_profiles)
+    # キーワードが一意にフォルダを指すならLLMを呼ばずに確定させる
+    hit = match_include_keywords(file_name, folder_profiles)
+    if hit:
+        return hit
+
+    if joined is None:
+        joined = _fold_profiles_for_prompt(folder_profiles)
     prompt = f"""
     あなたは書類フォルダの分類アシスタントです。
-    次のファイル名と候補カテゴリ一覧を見て、最も適切なカテゴリを1つ選んでください。
+    次の候補カテゴリ一覧からファイル名に最も適切なカテゴリを1つ選んでください。
 
-    ファイル名: {file_name}
     候補カテゴリ:
     {joined}
 
     出力は候補カテゴリ名のいずれかをそのまま1行で返してください。
     説明や要約、追加の文章は付けないでください。
     どれも適切でない場合は "NONE" とだけ返してください。
+
+    ファイル名: {file_name}
     """
 
-    resp = client.chat.completions.create(
-        model="gpt-5",
+    resp = _chat_completion(
+        model=_TITLE_MODEL,
         messages=[{"role": "user", "content": prompt}],
         max_tokens=10,
         temperature=0,
     )
     return resp.choices[0].message.content.strip()
+
+
+def classify_batch_with_ai(items: List[Tuple[str, str]], folder_profiles: List[Dict[str, Any]], *, joined: Optional[str] = None) -> List[str]:
+    """複数ファイルの (ファイル名, 本文抜粋) を1回のチャット補完で分類する。
+
+    classify_with_ai のバッチ版。候補一覧や指示文を1回分の入力トークンで
+    共有できるうえ、K件のHTTP往復が1回になる。入力と同じ順・同じ件数の
+    カテゴリ名リストを返し、件数不一致は ValueError（呼び出し側で単発に
+    フォールバックさせる）。
+    """
+
+    if not folder_profiles or not items:
+        return []
+
+    if joined is None:
+        joined = _fold_profiles_for_prompt(folder_profiles)
+    blocks = "\n\n".join(
+        f"{i + 1}. ファイル名: {name}\n本文抜粋:\n{text}"
+        for i, (name, text) in enumerate(items)
+    )
+    prompt = f"""
+    あなたは書類の分類アシスタントです。
+    以下の候補から、各ファイルを分類する最も適切なフォルダ名を1つずつ選んでください。
+
+    利用可能なフォルダ候補:
+    {joined}
+
+    出力はJSONオブジェクトで、キー "categories" に入力と同じ順・同じ件数の
+    フォルダ名の配列を入れてください。適切なフォルダがないファイルは "NONE" としてください。
+    説明や追加の文章は付けないでください。
+
+    ファイル一覧:
+    {blocks}
+    """
+
+    resp = _chat_completion(
+        model=_CONTENT_MODEL,
+        messages=[{"role": "user", "content": prompt}],
+        max_tokens=10 * len(items) + 20,
+        temperature=0,
+        response_format={"type": "json_object"},
+    )
+    data = json.loads(resp.choices[0].message.content)
+    cats = data.get("categories")
+    if not isinstance(cats, list) or len(cats) != len(items):
+        raise ValueError(f"batch size mismatch: sent {len(items)}, got {cats!r}")
+    return [str(c).strip() for c in cats]
+
+
+def classify_titles_batch(file_names: List[str], folder_profiles: List[Dict[str, Any]], *, joined: Optional[str] = None) -> List[str]:
+    """複数のファイル名を1回のチャット補完でまとめて分類する。
+
+    classify_title_with_ai のバッチ版。K件で K 往復だった所を1往復にする。
+    入力と同じ順・同じ件数のカテゴリ名リストを返す（不明は "NONE"）。
+    件数が合わないレスポンスは ValueError にして呼び出し側で単発にフォールバックさせる。
+    """
+
+    if not folder_profiles or not file_names:
+        return []
+
+    if joined is None:
+        joined = _fold_profiles_for_prompt(folder_profiles)
+    numbered = "\n".join(f"{i + 1}. {name}" for i, name in enumerate(file_names))
+    prompt = f"""
+    あなたは書類フォルダの分類アシスタントです。
+    次の候補カテゴリ一覧を見て、各ファイルに最も適切なカテゴリを1つずつ選んでください。
+
+    候補カテゴリ:
+    {joined}
+
+    出力はJSONオブジェクトで、キー "categories" に入力と同じ順・同じ件数の
+    カテゴリ名の配列を入れてください。適切なカテゴリがないファイルは "NONE" としてください。
+    説明や追加の文章は付けないでください。
+
+    ファイル名リスト:
+    {numbered}
+    """
+
+    resp = _chat_completion(
+        model=_TITLE_MODEL,
+        messages=[{"role": "user", "content": prompt}],
+        max_tokens=10 * len(file_names) + 20,
+        temperature=0,
+        response_format={"type": "json_object"},
+    )
+    data = json.loads(resp.choices[0].message.content)
+    cats = data.get("categories")
+    if not isinstance(cats, list) or len(cats) != len(file_names):
+        raise ValueError(f"batch size mismatch: sent {len(file_names)}, got {cats!r}")
+    return [str(c).strip() for c in cats]
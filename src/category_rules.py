@@ -1,11 +1,15 @@
 from __future__ import annotations
 
-import json
 import os
+import threading
 from pathlib import Path
-from typing import Any, Dict
+from typing import Any, Dict, Optional, Tuple
 
-_CATEGORY_RULES_CACHE: Dict[str, Dict[str, Any]] | None = None
+import orjson
+
+# (path, mtime_ns, data) — mtime が変わらない限り再読み込みしない
+_cache: Optional[Tuple[Path, int, Dict[str, Any]]] = None
+_lock = threading.Lock()
 
 
 def _default_rules_path() -> Path:
@@ -13,11 +17,13 @@ def _default_rules_path() -> Path:
 
 
 def load_category_profiles() -> Dict[str, Dict[str, Any]]:
-    """Load category profiles from JSON configuration if available."""
+    """Load category profiles from JSON configuration if available.
+
+    キャッシュは mtime ベースなので、ルールJSONの編集は再起動なしで
+    次の呼び出しから反映される。ヒット時のコストは stat 1回分。
+    """
 
-    global _CATEGORY_RULES_CACHE
-    if _CATEGORY_RULES_CACHE is not None:
-        return _CATEGORY_RULES_CACHE
+    global _cache
 
     env_path = os.getenv("CATEGORY_RULES_PATH")
     candidate_paths = []
@@ -27,14 +33,18 @@ def load_category_profiles() -> Dict[str, Dict[str, Any]]:
 
     for path in candidate_paths:
         try:
-            if path.is_file():
-                with open(path, "r", encoding="utf-8") as fp:
-                    data = json.load(fp)
-                    if isinstance(data, dict):
-                        _CATEGORY_RULES_CACHE = data
-                        return _CATEGORY_RULES_CACHE
-        except Exception:
+            st = path.stat()
+        except OSError:
             continue
-
-    _CATEGORY_RULES_CACHE = {}
-    return _CATEGORY_RULES_CACHE
+        with _lock:
+            if _cache is not None and _cache[0] == path and _cache[1] == st.st_mtime_ns:
+                return _cache[2]
+            try:
+                data = orjson.loads(path.read_bytes())
+            except Exception:
+                continue
+            if isinstance(data, dict):
+                _cache = (path, st.st_mtime_ns, data)
+                return data
+
+    return {}
@@ -1,30 +1,39 @@
 import re
 from typing import Optional
 
-DATE_RX = r"(20\d{2})[./年-](\d{1,2})[./月-](\d{1,2})"
+# パターンはすべてモジュールロード時にコンパイルしておく
+DATE_RX = re.compile(r"(20\d{2})[./年-](\d{1,2})[./月-](\d{1,2})")
+
+# カテゴリ判定は1本の名前付きグループ正規表現で1回だけ走査する
+_CAT_RX = re.compile(
+    r"(?P<invoice>請求書|INVOICE)|(?P<receipt>領収書|RECEIPT)|(?P<contract>契約)",
+    re.I,
+)
+_CAT_PRIORITY = ("invoice", "receipt", "contract")
+
+_INVOICE_NO_RX = re.compile(r"(請求書番号|INVOICE NO[:：]?)\s*([A-Za-z0-9-]+)", re.I)
+_CLIENT_RX = re.compile(r"(株式会社.*?)[\s　]")
 
 def guess_category(text: str) -> str:
-    if re.search(r"請求書|INVOICE", text, re.I):
-        return "invoice"
-    if re.search(r"領収書|RECEIPT", text, re.I):
-        return "receipt"
-    if re.search(r"契約", text):
-        return "contract"
+    # 出現位置でなく優先度（請求書 > 領収書 > 契約）で決めるので、
+    # 1回の走査でヒットしたグループを集めてから選ぶ
+    hits = {m.lastgroup for m in _CAT_RX.finditer(text)}
+    for cat in _CAT_PRIORITY:
+        if cat in hits:
+            return cat
     return "misc"
 
 def guess_date(text: str) -> Optional[str]:
-    m = re.search(DATE_RX, text)
+    m = DATE_RX.search(text)
     if m:
         yyyy, mm, dd = m.groups()
         return f"{int(yyyy):04d}{int(mm):02d}{int(dd):02d}"
     return None
 
 def guess_invoice_number(text: str) -> Optional[str]:
-    m = re.search(r"(請求書番号|INVOICE NO[:：]?)\s*([A-Za-z0-9-]+)", text, re.I)
+    m = _INVOICE_NO_RX.search(text)
     return m.group(2) if m else None
 
 def guess_client_name(text: str) -> Optional[str]:
-    m = re.search(r"(株式会社.*?)[\s　]", text)
+    m = _CLIENT_RX.search(text)
     return m.group(1) if m else None
-
-
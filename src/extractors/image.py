@@ -1,7 +1,30 @@
+import os
 from io import BytesIO
-from PIL import Image
+from PIL import Image, ImageOps
 import pytesseract
 
+# デコード爆弾対策（デフォルトより厳しめに制限）
+Image.MAX_IMAGE_PIXELS = 64_000_000
+
+# これ以上大きい画像は縮小してからOCRする（分類用途なら精度はほぼ落ちない）
+_MAX_SIDE = 2000
+
+# グレースケール化+自動コントラストの前処理を入れるか。
+# PILのC実装ループで走るので前処理自体は軽く、Tesseract側の仕事も減るが、
+# 写真系の原稿では裏目に出ることもあるのでフラグで切り替えられるようにする
+_PREPROCESS = os.getenv("DAS_OCR_PREPROCESS", "1") != "0"
+
+
+def _preprocess(img: Image.Image) -> Image.Image:
+    gray = ImageOps.grayscale(img)
+    return ImageOps.autocontrast(gray)
+
+
 def extract_text_from_image_bytes(b: bytes) -> str:
     img = Image.open(BytesIO(b))
+    if max(img.size) > _MAX_SIDE:
+        # 縮小はLANCZOSで。安い補間だと細い字画が潰れてOCR誤読が増える
+        img.thumbnail((_MAX_SIDE, _MAX_SIDE), Image.LANCZOS)
+    if _PREPROCESS:
+        img = _preprocess(img)
     return pytesseract.image_to_string(img, lang="jpn+eng")
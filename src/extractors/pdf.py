@@ -1,8 +1,27 @@
+from typing import Optional
+
 import fitz  # PyMuPDF
 
-def extract_text_from_pdf_bytes(b: bytes) -> str:
+# レイアウト解析を抑えた高速寄りの抽出フラグ
+_TEXT_FLAGS = fitz.TEXT_PRESERVE_LIGATURES | fitz.TEXT_INHIBIT_SPACES
+
+def extract_text_from_pdf_bytes(b: bytes, max_chars: Optional[int] = None) -> str:
+    """PDFからテキストを抽出する。
+
+    分類には先頭の数百文字しか使わないので、max_chars を超えたら
+    残りのページは読まずに打ち切る。
+    """
     with fitz.open(stream=b, filetype="pdf") as doc:
         text = []
+        total = 0
         for page in doc:
-            text.append(page.get_text("text"))
+            t = page.get_text("text", flags=_TEXT_FLAGS)
+            if not t:
+                # "text" が空のページはブロック単位でもう一度だけ試す
+                blocks = page.get_text("blocks")
+                t = "\n".join(blk[4] for blk in blocks if len(blk) > 4 and isinstance(blk[4], str))
+            text.append(t)
+            total += len(t)
+            if max_chars is not None and total >= max_chars:
+                break
         return "\n".join(text).strip()
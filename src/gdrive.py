@@ -21,10 +21,11 @@ def get_service():
 
 def list_files_in_folder(svc, folder_id: str) -> List[Dict]:
     q = f"'{folder_id}' in parents and trashed = false"
-    fields = "nextPageToken, files(id,name,mimeType,parents,createdTime,modifiedTime,md5Checksum)"
+    # 下流(main.py)は id/name/mimeType/parents しか見ないので絞る
+    fields = "nextPageToken, files(id,name,mimeType,parents)"
     files, page_token = [], None
     while True:
-        resp = svc.files().list(q=q, fields=fields, pageToken=page_token).execute()
+        resp = svc.files().list(q=q, fields=fields, pageSize=1000, pageToken=page_token).execute()
         files.extend(resp.get("files", []))
         page_token = resp.get("nextPageToken")
         if not page_token:
@@ -5,6 +5,8 @@ from datetime import datetime
 from dotenv import load_dotenv
 from src import gdrive
 
+_WS_RE = re.compile(r"\s+")
+
 CATS = [
     ("invoice",   re.compile(r"請求|invoice", re.I)),
     ("receipt",   re.compile(r"領収|receipt", re.I)),
@@ -29,7 +31,7 @@ def make_new_name(orig: str, category: str) -> str:
     base, ext = (orig.rsplit(".",1)+[""])[:2]
     ext = "."+ext.lower() if ext else ""
     date = datetime.now().strftime("%Y%m%d")
-    base = re.sub(r"\s+", "_", base)[:30]
+    base = _WS_RE.sub("_", base)[:30]
     return f"{category}_{date}_{base}{ext}"
 
 def main():
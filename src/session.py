@@ -1,47 +1,72 @@
 from __future__ import annotations
-import json, os
+import os
+
+import orjson
 from typing import Any, Dict, Optional
 
-STATE_FILE = "/var/lib/das/state.json"
-CREDS_DIR = "/var/lib/das/creds"
+import redis.asyncio as redis
+
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+
+# TTL: state はログインフローの間だけ、クレデンシャルは6時間で失効
+STATE_TTL = 600
+CREDS_TTL = 6 * 3600
+
+_pool: Optional[redis.ConnectionPool] = None
+_client: Optional[redis.Redis] = None
+
+
+def _r() -> redis.Redis:
+    global _pool, _client
+    if _client is None:
+        _pool = redis.ConnectionPool.from_url(
+            REDIS_URL, max_connections=50, decode_responses=True
+        )
+        _client = redis.Redis(connection_pool=_pool)
+    return _client
+
+
+async def startup():
+    """アプリの lifespan 開始時に接続プールを張っておく。"""
+    await _r().ping()
+
+
+async def shutdown():
+    global _pool, _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+    if _pool is not None:
+        await _pool.disconnect()
+        _pool = None
+
+
+def _state_key(key: str) -> str:
+    return f"das:state:{key}"
+
+
+def _creds_key(key: str) -> str:
+    return f"das:creds:{key}"
 
-os.makedirs(os.path.dirname(STATE_FILE), exist_ok=True)
-os.makedirs(CREDS_DIR, exist_ok=True)
 
 # ---- state helpers ----
 
-def _state_load() -> Dict[str, Any]:
-    try:
-        with open(STATE_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception:
-        return {}
+async def state_set(key: str, payload: Dict[str, Any]):
+    await _r().setex(_state_key(key), STATE_TTL, orjson.dumps(payload))
 
-def _state_save(data: Dict[str, Any]):
-    with open(STATE_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f)
 
-def state_set(key: str, payload: Dict[str, Any]):
-    data = _state_load()
-    data[key] = payload
-    _state_save(data)
+async def state_get(key: str) -> Optional[Dict[str, Any]]:
+    raw = await _r().get(_state_key(key))
+    if raw is None:
+        return None
+    return orjson.loads(raw)
 
-def state_get(key: str) -> Optional[Dict[str, Any]]:
-    return _state_load().get(key)
 
 # ---- credentials helpers ----
 
-def creds_path(key: str) -> str:
-    safe = "".join(c for c in key if c.isalnum() or c in ("-", "_"))[:100]
-    return os.path.join(CREDS_DIR, f"{safe}.json")
+async def creds_save(key: str, creds_json: str):
+    await _r().setex(_creds_key(key), CREDS_TTL, creds_json)
 
-def creds_save(key: str, creds_json: str):
-    with open(creds_path(key), "w", encoding="utf-8") as f:
-        f.write(creds_json)
 
-def creds_load(key: str) -> Optional[str]:
-    p = creds_path(key)
-    if not os.path.exists(p):
-        return None
-    with open(p, "r", encoding="utf-8") as f:
-        return f.read()
+async def creds_load(key: str) -> Optional[str]:
+    return await _r().get(_creds_key(key))
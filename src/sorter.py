@@ -4,32 +4,118 @@ from googleapiclient.discovery import Resource
 from googleapiclient.errors import HttpError
 
 # 追加 import
-import os, io, json, re
+import functools
+import hashlib
+import os, io, sqlite3, tempfile, threading, time
+
+import orjson
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from difflib import SequenceMatcher
+
+try:
+    from rapidfuzz import fuzz, process as rf_process  # type: ignore[import]
+except ImportError:  # pragma: no cover - optional speedup
+    rf_process = None
+import httplib2  # type: ignore[import]
+import google_auth_httplib2  # type: ignore[import]
+
+try:
+    import ahocorasick  # type: ignore[import]
+except ImportError:  # pragma: no cover - optional speedup
+    ahocorasick = None
 from googleapiclient.http import MediaIoBaseDownload  # type: ignore[import]
-from .ai_classifier import classify_with_ai, classify_title_with_ai
+from .ai_classifier import (
+    classify_batch_with_ai,
+    classify_with_ai,
+    classify_title_with_ai,
+    classify_titles_batch,
+    render_profiles_prompt,
+)
 from .extractors.pdf import extract_text_from_pdf_bytes
 from .extractors.image import extract_text_from_image_bytes
 from .extractors.excel import extract_text_from_xlsx
 from .category_rules import load_category_profiles  # type: ignore[import]
 
-CACHE_PATH = "/var/lib/das/classify-cache.json"
-os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+CACHE_PATH = "/var/lib/das/classify-cache.db"
+_LEGACY_CACHE_PATH = "/var/lib/das/classify-cache.json"
+
+# md5→カテゴリのキャッシュはSQLite。JSON全読み/全書きだった頃と違い
+# 1件ずつ即時コミットされるので、途中クラッシュしても分類結果は残る
+_cache_conn: Optional[sqlite3.Connection] = None
+_cache_conn_lock = threading.Lock()
+# AIが「どのフォルダでもない」と判定した内容もキャッシュする際の番兵値。
+# 同じ内容を再走査するたびにダウンロード+OCR+AIをやり直さないため
+_CACHE_NOMATCH = "__NOMATCH__"
+
+# 既知md5のインメモリ集合。ミス（大半のケース）をSQLiteに触れずに返すための
+# ネガティブルックアップ用。md5 32文字×件数なので数十万件でも数MBで済む
+_cache_keys: Optional[set] = None
+
+
+def _cache_db() -> sqlite3.Connection:
+    global _cache_conn, _cache_keys
+    if _cache_conn is None:
+        # ディレクトリ作成もここで。import時に毎ワーカーがsyscallを払わない
+        os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+        conn = sqlite3.connect(CACHE_PATH, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS cache(md5 TEXT PRIMARY KEY, category TEXT)")
+        _migrate_legacy_cache(conn)
+        _cache_keys = {row[0] for row in conn.execute("SELECT md5 FROM cache")}
+        _cache_conn = conn
+    return _cache_conn
 
-def _load_cache() -> Dict[str, str]:
+
+def _migrate_legacy_cache(conn: sqlite3.Connection):
+    """旧JSONキャッシュが残っていれば一度だけ取り込む（AI再呼び出しの節約）。"""
     try:
-        with open(CACHE_PATH, "r", encoding="utf-8") as f:
-            return json.load(f)
+        with open(_LEGACY_CACHE_PATH, "rb") as f:
+            data = orjson.loads(f.read())
+        if isinstance(data, dict):
+            conn.executemany(
+                "INSERT OR IGNORE INTO cache(md5, category) VALUES(?, ?)",
+                [(k, v) for k, v in data.items() if k and isinstance(v, str)],
+            )
+        os.replace(_LEGACY_CACHE_PATH, _LEGACY_CACHE_PATH + ".migrated")
+    except FileNotFoundError:
+        pass
     except Exception:
-        return {}
+        pass
+
+
+def _cache_get(md5: str) -> Optional[str]:
+    with _cache_conn_lock:
+        conn = _cache_db()
+        if md5 not in _cache_keys:
+            return None
+        row = conn.execute(
+            "SELECT category FROM cache WHERE md5=?", (md5,)
+        ).fetchone()
+    return row[0] if row else None
 
-def _save_cache(data: Dict[str, str]):
-    with open(CACHE_PATH, "w", encoding="utf-8") as f:
-        json.dump(data, f)
+
+def _cache_put(md5: str, category: str):
+    with _cache_conn_lock:
+        _cache_db().execute(
+            "INSERT OR REPLACE INTO cache(md5, category) VALUES(?, ?)", (md5, category)
+        )
+        _cache_keys.add(md5)
 
 # 既存関数群
 
-def list_subfolders(service: Resource, parent_id: str) -> List[Dict[str, Any]]:
+# 親フォルダ→子フォルダ一覧の短期キャッシュ。サーバー運用で同じ親に
+# 連続してソート要求が来るとき、毎回のページング往復を省く。
+# 子フォルダの増減はまれなので短いTTLで十分
+_SUBFOLDER_TTL = 60.0
+_subfolder_cache: Dict[str, Tuple[float, List[Dict[str, Any]]]] = {}
+_subfolder_cache_lock = threading.Lock()
+
+
+def list_subfolders(service: Resource, parent_id: str, http=None) -> List[Dict[str, Any]]:
+    with _subfolder_cache_lock:
+        hit = _subfolder_cache.get(parent_id)
+        if hit is not None and time.monotonic() - hit[0] < _SUBFOLDER_TTL:
+            return hit[1]
     q = (
         f"'{parent_id}' in parents and "
         "mimeType = 'application/vnd.google-apps.folder' and "
@@ -39,35 +125,201 @@ def list_subfolders(service: Resource, parent_id: str) -> List[Dict[str, Any]]:
     page_token = None
     while True:
         resp = service.files().list(
-            q=q, fields="nextPageToken, files(id,name)", pageToken=page_token
-        ).execute()
+            q=q, fields="nextPageToken, files(id,name)", pageSize=1000, pageToken=page_token
+        ).execute(http=http)
         files.extend(resp.get("files", []))
         page_token = resp.get("nextPageToken")
         if not page_token:
             break
+    with _subfolder_cache_lock:
+        _subfolder_cache[parent_id] = (time.monotonic(), files)
     return files
 
-def list_files_directly_under(service: Resource, parent_id: str) -> List[Dict[str, Any]]:
+# 名前ベースの仕分けに必要な最小フィールドと、AI仕分けで追加で要るメタ。
+# 余計なフィールドはJSONの転送量とパース時間にそのまま効く
+_LIST_FIELDS_BASIC = "nextPageToken, files(id,name,parents,mimeType)"
+_LIST_FIELDS_CONTENT = "nextPageToken, files(id,name,parents,mimeType,size,md5Checksum)"
+
+
+def list_files_directly_under(service: Resource, parent_id: str, http=None, *, content_meta: bool = False) -> List[Dict[str, Any]]:
     q = (
         f"'{parent_id}' in parents and "
         "mimeType != 'application/vnd.google-apps.folder' and "
         "trashed = false"
     )
+    fields = _LIST_FIELDS_CONTENT if content_meta else _LIST_FIELDS_BASIC
     files: List[Dict[str, Any]] = []
     page_token = None
     while True:
         resp = service.files().list(
-            q=q, fields="nextPageToken, files(id,name,parents,mimeType)", pageToken=page_token
-        ).execute()
+            q=q, fields=fields, pageSize=1000, pageToken=page_token
+        ).execute(http=http)
         files.extend(resp.get("files", []))
         page_token = resp.get("nextPageToken")
         if not page_token:
             break
     return files
 
-def move_file(service: Resource, file_id: str, dest_folder_id: str) -> Dict[str, Any]:
-    meta = service.files().get(fileId=file_id, fields="parents,name").execute()
-    prev_parents = ",".join(meta.get("parents", [])) if meta.get("parents") else None
+# Drive batch API は1リクエストあたり100件まで
+_BATCH_LIMIT = 100
+# チャンクを並列実行するスレッド数（ユーザー毎QPS制限を超えない程度）
+_BATCH_WORKERS = 4
+
+
+def _thread_http(service: Resource):
+    """バッチ実行スレッド用の認可済みhttp。httplib2はスレッドセーフでないため毎回作る。"""
+    creds = getattr(service._http, "credentials", None)
+    if creds is None:
+        return None
+    return google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http())
+
+
+_thread_local = threading.local()
+
+
+def _local_http(service: Resource):
+    """ワーカースレッドごとに1つ使い回す認可済みhttp。"""
+    http = getattr(_thread_local, "http", None)
+    if http is None:
+        http = _thread_http(service)
+        _thread_local.http = http
+    return http
+
+
+def _build_name_automaton(names_to_val: Dict[str, Dict[str, Any]]):
+    """フォルダ名（キー）を一括マッチするAho-Corasickオートマトン。
+
+    ファイル数F×フォルダ数SのPythonレベル部分文字列走査を、
+    ファイル名1回のC実装スキャンに置き換える。未インストール時は None。
+    """
+    if ahocorasick is None:
+        return None
+    automaton = ahocorasick.Automaton()
+    added = False
+    for key, val in names_to_val.items():
+        if key:
+            automaton.add_word(key, val)
+            added = True
+    if not added:
+        return None
+    automaton.make_automaton()
+    return automaton
+
+
+_GRAM_N = 3
+
+
+def _build_gram_index(sub_by_norm: Dict[str, Dict[str, Any]]) -> Tuple[Dict[str, set], List[str]]:
+    """正規化済みフォルダ名の3-gram → キー集合の転置インデックス。
+
+    _resolve_cat の部分一致フォールバックを、全キー線形走査から
+    「カテゴリ名の3-gramが指す候補だけ検証」に絞るために使う。
+    3文字未満の短いキーはgramを持てないので別リストで線形照合する。
+    """
+    gram_index: Dict[str, set] = {}
+    short_keys: List[str] = []
+    for key in sub_by_norm:
+        if not key:
+            continue
+        if len(key) < _GRAM_N:
+            short_keys.append(key)
+            continue
+        for i in range(len(key) - _GRAM_N + 1):
+            gram_index.setdefault(key[i:i + _GRAM_N], set()).add(key)
+    return gram_index, short_keys
+
+
+def _first_name_hit(automaton, subject: str, fallback: Dict[str, Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """subject に含まれる最初のフォルダ名を返す。automaton が無ければ線形走査。"""
+    if automaton is not None:
+        for _, val in automaton.iter(subject):
+            return val
+        return None
+    for key, val in fallback.items():
+        if key and key in subject:
+            return val
+    return None
+
+
+def _list_folder(service: Resource, parent_id: str, *, content_meta: bool = False) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """サブフォルダ一覧とファイル一覧を並行で取得する。
+
+    ページングは nextPageToken が逐次しか分からないので各一覧の中では直列だが、
+    2つの一覧は独立なので同時に取りに行ける（それぞれ専用のhttpを使う）。
+    """
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        sub_future = pool.submit(list_subfolders, service, parent_id, _thread_http(service))
+        file_future = pool.submit(
+            functools.partial(list_files_directly_under, content_meta=content_meta),
+            service, parent_id, _thread_http(service),
+        )
+        return sub_future.result(), file_future.result()
+
+
+def _execute_moves(
+    service: Resource,
+    planned: List[Tuple[Dict[str, Any], str, Dict[str, Any]]],
+) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """計画済みの移動 (file, dest_folder_id, 追加フィールド) をbatch HTTPでまとめて実行する。
+
+    1ファイル=1往復だった files.update を 100件/リクエスト に集約し、
+    チャンクは小さなスレッドプールで並列に投げる。結果はコールバックで
+    moved/skipped に振り分けて返す。
+    """
+    moved: List[Dict[str, Any]] = []
+    skipped: List[Dict[str, Any]] = []
+    if not planned:
+        return moved, skipped
+
+    lock = threading.Lock()
+
+    def run_chunk(chunk: List[Tuple[Dict[str, Any], str, Dict[str, Any]]]):
+        def on_done(request_id, response, exception):
+            f, _, extra = chunk[int(request_id)]
+            fid = f.get("id")
+            fname = f.get("name", "")
+            with lock:
+                if exception is not None:
+                    skipped.append({"file_id": fid, "name": fname, "reason": f"move_failed:{exception}"})
+                else:
+                    entry = {
+                        "file_id": response.get("id", fid),
+                        "name": response.get("name", fname),
+                    }
+                    entry.update(extra)
+                    moved.append(entry)
+
+        batch = service.new_batch_http_request(callback=on_done)
+        for i, (f, dest_id, _) in enumerate(chunk):
+            prev_parents = ",".join(f.get("parents", [])) if f.get("parents") else None
+            batch.add(
+                service.files().update(
+                    fileId=f["id"],
+                    addParents=dest_id,
+                    removeParents=prev_parents,
+                    fields="id,name,parents",
+                ),
+                request_id=str(i),
+            )
+        batch.execute(http=_thread_http(service))
+
+    chunks = [planned[i:i + _BATCH_LIMIT] for i in range(0, len(planned), _BATCH_LIMIT)]
+    if len(chunks) == 1:
+        run_chunk(chunks[0])
+    else:
+        with ThreadPoolExecutor(max_workers=_BATCH_WORKERS) as pool:
+            for future in [pool.submit(run_chunk, c) for c in chunks]:
+                future.result()
+
+    return moved, skipped
+
+
+def move_file(service: Resource, file_id: str, dest_folder_id: str, old_parents: Optional[List[str]] = None) -> Dict[str, Any]:
+    # 一覧取得時に parents が分かっていれば files.get 1往復を省ける
+    if old_parents is None:
+        meta = service.files().get(fileId=file_id, fields="parents,name").execute()
+        old_parents = meta.get("parents", [])
+    prev_parents = ",".join(old_parents) if old_parents else None
     return service.files().update(
         fileId=file_id,
         addParents=dest_folder_id,
@@ -76,72 +328,136 @@ def move_file(service: Resource, file_id: str, dest_folder_id: str) -> Dict[str,
     ).execute()
 
 def sort_files_by_subfolder_name(service: Resource, parent_id: str) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
-    subfolders = list_subfolders(service, parent_id)
-    files = list_files_directly_under(service, parent_id)
+    subfolders, files = _list_folder(service, parent_id)
 
     sub_by_name: Dict[str, Dict[str, str]] = {
         s["name"].lower(): {"id": s["id"], "name": s["name"]} for s in subfolders
     }
 
-    moved: List[Dict[str, Any]] = []
+    automaton = _build_name_automaton(sub_by_name)
+
     skipped: List[Dict[str, Any]] = []
+    planned: List[Tuple[Dict[str, Any], str, Dict[str, Any]]] = []
 
     for f in files:
         fname = f.get("name", "")
         fid = f.get("id")
         low = fname.lower()
 
-        dest = None
-        for sub_name, sub in sub_by_name.items():
-            if sub_name and sub_name in low:
-                dest = sub
-                break
+        dest = _first_name_hit(automaton, low, sub_by_name)
 
         if not dest:
             skipped.append({"file_id": fid, "name": fname, "reason": "no_subfolder_name_match"})
             continue
 
-        try:
-            res = move_file(service, file_id=fid, dest_folder_id=dest["id"])
-            moved.append({"file_id": res.get("id", fid), "name": res.get("name", fname), "to_folder": dest["name"]})
-        except HttpError as e:
-            skipped.append({"file_id": fid, "name": fname, "reason": f"move_failed: {e}"})
+        planned.append((f, dest["id"], {"to_folder": dest["name"]}))
 
+    moved, move_skipped = _execute_moves(service, planned)
+    skipped.extend(move_skipped)
     return moved, skipped
 
 # ---- AI OCR + 分類 ----
 
+# text_max はUTF-8バイト数の予算。トークン数（≒課金とレイテンシ）は
+# 文字数よりバイト数に相関するので、CJKでも安定した上限になる
 _DEF_TEXT_MAX = 2000
 _DEF_MAX_FILES = 100
 _DEF_MAX_BYTES = 20 * 1024 * 1024  # 20MB
 
-_norm_rx = re.compile(r"\s+")
+# 空白除去は正規表現でなく translate の1パスで済ませる（全角スペース含む）
+_WS_DEL = str.maketrans("", "", " \t\n\r\f\v\u3000")
 
+@functools.lru_cache(maxsize=8192)
 def _norm(s: str) -> str:
-    return _norm_rx.sub("", s).lower()
+    # 同じファイル名/キーワードが複数の照合パスで正規化されるのでメモ化する。
+    # casefold は lower と違い全角/合字も畳み込むのでCJK混在名でも安定する
+    return s.translate(_WS_DEL).casefold()
 
 _DEF_PLAIN_EXTS = {".txt", ".csv", ".md"}
+_IMG_EXTS = (".png", ".jpg", ".jpeg", ".webp", ".heic")
+_XLSX_MIMES = ("application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",)
 
+# PDF/OCR/xlsx の抽出はCPUバウンドでGILを手放しきらないので、
+# プロセスプールに逃がしてコア数ぶんスケールさせる。
+_EXTRACT_POOL: Optional[ProcessPoolExecutor] = None
+_extract_pool_lock = threading.Lock()
 
-def _rule_score(subject: str, profile: Dict[str, Any]) -> float:
-    subject_norm = _norm(subject)
+
+def _warm_extractors():  # pragma: no cover - 子プロセス側で実行される
+    # fitz / pytesseract のimportを先に済ませてプールを温めておく
+    from .extractors import pdf, image, excel  # noqa: F401
+
+
+def _extract_pool() -> ProcessPoolExecutor:
+    global _EXTRACT_POOL
+    if _EXTRACT_POOL is None:
+        with _extract_pool_lock:
+            if _EXTRACT_POOL is None:
+                _EXTRACT_POOL = ProcessPoolExecutor(
+                    max_workers=os.cpu_count(), initializer=_warm_extractors
+                )
+    return _EXTRACT_POOL
+
+
+def _pool_noop():  # pragma: no cover - 子プロセス側で実行される
+    return None
+
+
+def warm_extract_pool() -> None:
+    """抽出プールのワーカーを全員forkさせて initializer を走らせておく。
+
+    ProcessPoolExecutor は生成時点ではプロセスを作らず、最初の submit で
+    遅延spawnするので、no-opを人数ぶん投げて待つことで起動時に温める。
+    """
+    pool = _extract_pool()
+    for fut in [pool.submit(_pool_noop) for _ in range(os.cpu_count() or 1)]:
+        fut.result()
+
+# ファイル単位の 抽出+分類 パイプラインの並列度。
+# OpenAI / Drive ダウンロードはそれぞれ別のセマフォでバースト制限する。
+_AI_WORKERS = 8
+# タイトルAIバッチの1リクエストあたり件数
+_TITLE_BATCH = 20
+# 内容AIバッチの1リクエストあたり件数（本文抜粋込みなのでタイトルより控えめ）
+_CONTENT_BATCH = 10
+_OPENAI_SEM = threading.Semaphore(4)
+_DOWNLOAD_SEM = threading.Semaphore(10)
+
+
+def _clip_utf8(s: str, nbytes: int) -> str:
+    """UTF-8でnbytes以内になるよう末尾を切り詰める（文字境界は安全に処理）。"""
+    b = s.encode("utf-8")
+    if len(b) <= nbytes:
+        return s
+    return b[:nbytes].decode("utf-8", errors="ignore")
+
+
+def _norm_words(words: Optional[List[str]]) -> List[str]:
+    return [w for w in (_norm(word) for word in (words or []) if word) if w]
+
+
+def _rule_score(subject_norm: str, profile: Dict[str, Any]) -> float:
+    """正規化済み subject をスコアリングする。
+
+    include/exclude はプロファイル構築時に `_inc_norm`/`_exc_norm` として
+    正規化済み。外部由来のプロファイルに無ければここで都度正規化する。
+    """
     if not subject_norm:
         return 0.0
 
-    excludes = profile.get("exclude") or []
-    for word in excludes:
-        if not word:
-            continue
-        if _norm(word) and _norm(word) in subject_norm:
+    excludes = profile.get("_exc_norm")
+    if excludes is None:
+        excludes = _norm_words(profile.get("exclude"))
+    for word_norm in excludes:
+        if word_norm in subject_norm:
             return -1.0
 
-    includes = profile.get("include") or []
+    includes = profile.get("_inc_norm")
+    if includes is None:
+        includes = _norm_words(profile.get("include"))
     score = 0.0
-    for word in includes:
-        if not word:
-            continue
-        word_norm = _norm(word)
-        if word_norm and word_norm in subject_norm:
+    for word_norm in includes:
+        if word_norm in subject_norm:
             score += 1.0
 
     if score > 0:
@@ -153,11 +469,79 @@ def _rule_score(subject: str, profile: Dict[str, Any]) -> float:
     return 0.0
 
 
-def _best_profile_by_rules(subject: str, profiles: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
-    best_profile: Optional[Dict[str, Any]] = None
+def _build_rule_matcher(profiles: List[Dict[str, Any]]):
+    """全プロファイルの include/exclude 語を1つのオートマトンに畳み込む。
+
+    _rule_score のプロファイル×単語の `in` ループを、subject 1回の
+    Cレベル走査に置き換えるための前処理。1ソート実行で1回だけ構築し、
+    _best_profile_by_rules に渡して使い回す。未インストール時は None。
+    """
+    if ahocorasick is None:
+        return None
+    word_entries: Dict[str, set] = {}
+    for idx, profile in enumerate(profiles):
+        excludes = profile.get("_exc_norm")
+        if excludes is None:
+            excludes = _norm_words(profile.get("exclude"))
+        for word in excludes:
+            word_entries.setdefault(word, set()).add((idx, -1))
+        includes = profile.get("_inc_norm")
+        if includes is None:
+            includes = _norm_words(profile.get("include"))
+        for word in includes:
+            word_entries.setdefault(word, set()).add((idx, 1))
+    if not word_entries:
+        return None
+    automaton = ahocorasick.Automaton()
+    for word, entries in word_entries.items():
+        automaton.add_word(word, (word, tuple(entries)))
+    automaton.make_automaton()
+    return automaton
+
+
+def _best_profile_by_rules(
+    subject: str,
+    profiles: List[Dict[str, Any]],
+    matcher=None,
+) -> Optional[Dict[str, Any]]:
+    subject_norm = _norm(subject)
+    if not subject_norm:
+        return None
+
+    if matcher is not None:
+        # 1回の走査で全プロファイルの include/exclude ヒットを集計する。
+        # 同じ単語が複数回出ても従来どおり1回だけ数える
+        scores = [0.0] * len(profiles)
+        excluded = [False] * len(profiles)
+        seen: set = set()
+        for _, (word, entries) in matcher.iter(subject_norm):
+            if word in seen:
+                continue
+            seen.add(word)
+            for idx, sign in entries:
+                if sign < 0:
+                    excluded[idx] = True
+                else:
+                    scores[idx] += 1.0
+        best_profile: Optional[Dict[str, Any]] = None
+        best_score = 0.0
+        for idx, profile in enumerate(profiles):
+            if excluded[idx]:
+                continue
+            score = scores[idx]
+            if score <= 0:
+                name_norm = _norm(profile.get("name", ""))
+                if name_norm and name_norm in subject_norm:
+                    score = 0.5
+            if score > best_score:
+                best_profile = profile
+                best_score = score
+        return best_profile if best_score > 0 else None
+
+    best_profile = None
     best_score = 0.0
     for profile in profiles:
-        score = _rule_score(subject, profile)
+        score = _rule_score(subject_norm, profile)
         if score < 0:
             continue
         if score > best_score:
@@ -166,8 +550,15 @@ def _best_profile_by_rules(subject: str, profiles: List[Dict[str, Any]]) -> Opti
     return best_profile if best_score > 0 else None
 
 
-def _best_profile_by_similarity(title: str, profiles: List[Dict[str, Any]], threshold: float = 0.82) -> Optional[Dict[str, Any]]:
-    title_lower = title.lower()
+def _best_profile_by_similarity(title: str, profiles: List[Dict[str, Any]], threshold: float = 0.82, *, pre_folded: bool = False) -> Optional[Dict[str, Any]]:
+    title_lower = title if pre_folded else title.casefold()
+    if rf_process is not None:
+        # C++実装で全候補を一括スコアリング。score_cutoff 未満は早期打ち切り
+        names = [p.get("name", "").lower() for p in profiles]
+        hit = rf_process.extractOne(
+            title_lower, names, scorer=fuzz.ratio, score_cutoff=threshold * 100
+        )
+        return profiles[hit[2]] if hit else None
     best_profile: Optional[Dict[str, Any]] = None
     best_score = 0.0
     for profile in profiles:
@@ -180,48 +571,112 @@ def _best_profile_by_similarity(title: str, profiles: List[Dict[str, Any]], thre
     return None
 
 
-def _download_bytes(service: Resource, file_id: str) -> bytes:
-    buf = io.BytesIO()
+# まずは先頭だけ取るときのサイズ。分類は冒頭のテキストで足りることが多い
+_HEAD_BYTES = 256 * 1024
+
+
+def _download_range(service: Resource, file_id: str, *, max_bytes: int = _HEAD_BYTES, http=None) -> Optional[bytes]:
+    """Range ヘッダで先頭 max_bytes だけ取得する。対応外・失敗なら None。"""
+    req = service.files().get_media(fileId=file_id)
+    h = http if http is not None else service._http
+    try:
+        resp, content = h.request(req.uri, headers={"Range": f"bytes=0-{max_bytes - 1}"})
+    except Exception:
+        return None
+    if resp.status in (200, 206):
+        return content
+    return None
+
+
+# フル取得時のチャンクサイズ。デフォルトの100MBだと1チャンクで
+# 全量をメモリに積んでしまうので小さく刻む
+_DL_CHUNK = 1024 * 1024
+# この閾値まではメモリ、超えたら一時ファイルに退避（ワーカーのRSSを抑える）
+_DL_SPOOL = 8 * 1024 * 1024
+
+
+def _download_bytes(service: Resource, file_id: str, http=None, max_bytes: Optional[int] = None) -> bytes:
+    """ファイル全体（または先頭 max_bytes 以上）を取得する。
+
+    1MB 刻みで SpooledTemporaryFile に書くので、大きなPDFでも
+    ピークメモリはほぼファイルサイズ1本分に収まる。max_bytes を
+    渡すとそのぶん読めた時点でダウンロードを打ち切る。
+    """
     request = service.files().get_media(fileId=file_id)
-    downloader = MediaIoBaseDownload(buf, request)
-    done = False
-    while not done:
-        status, done = downloader.next_chunk()
-    return buf.getvalue()
+    if http is not None:
+        request.http = http
+    with tempfile.SpooledTemporaryFile(max_size=_DL_SPOOL) as buf:
+        downloader = MediaIoBaseDownload(buf, request, chunksize=_DL_CHUNK)
+        done = False
+        while not done:
+            status, done = downloader.next_chunk()
+            if max_bytes is not None and buf.tell() >= max_bytes:
+                break
+        buf.seek(0)
+        return buf.read()
+
+
+# 1ファイルの抽出に許す上限秒数。壊れたPDF等でパーサが固まっても
+# 待ち続けてワーカースレッドを塞がないようにする（TimeoutError→スキップ扱い）
+_EXTRACT_TIMEOUT = 120
+
+
+def _extract_pdf(data: bytes, max_chars: Optional[int]) -> str:
+    return _extract_pool().submit(extract_text_from_pdf_bytes, data, max_chars).result(timeout=_EXTRACT_TIMEOUT)
+
+
+def _extract_image(data: bytes, max_chars: Optional[int]) -> str:
+    return _extract_pool().submit(extract_text_from_image_bytes, data).result(timeout=_EXTRACT_TIMEOUT)
+
+
+def _extract_xlsx(data: bytes, max_chars: Optional[int]) -> str:
+    return _extract_pool().submit(extract_text_from_xlsx, data).result(timeout=_EXTRACT_TIMEOUT)
 
 
-def _extract_text(name: str, mime: str, data: bytes) -> str:
-    nl = name.lower()
+def _extract_plain(data: bytes, max_chars: Optional[int]) -> str:
+    # プレーンテキストとしてそのままデコード
+    return data.decode(errors="ignore")
+
+
+# 拡張子/MIME → 抽出関数のディスパッチ表。if の梯子を辞書引き1回にし、
+# 新しい形式はここに1行足すだけで対応できる
+_EXT_DISPATCH: Dict[str, Any] = {".pdf": _extract_pdf, ".xlsx": _extract_xlsx}
+_EXT_DISPATCH.update({ext: _extract_image for ext in _IMG_EXTS})
+_EXT_DISPATCH.update({ext: _extract_plain for ext in _DEF_PLAIN_EXTS})
+_MIME_DISPATCH: Dict[str, Any] = {"application/pdf": _extract_pdf}
+_MIME_DISPATCH.update({m: _extract_xlsx for m in _XLSX_MIMES})
+
+
+def _extract_text(name: str, mime: str, data: bytes, max_chars: Optional[int] = None) -> str:
+    ext = os.path.splitext(name)[1].lower()
+    fn = _EXT_DISPATCH.get(ext) or _MIME_DISPATCH.get(mime)
+    if fn is None and mime.startswith("image/"):
+        fn = _extract_image
+    if fn is None:
+        return ""
     try:
-        if mime == "application/pdf" or nl.endswith(".pdf"):
-            return extract_text_from_pdf_bytes(data)
-        if mime.startswith("image/") or any(nl.endswith(ext) for ext in (".png", ".jpg", ".jpeg", ".webp", ".heic")):
-            return extract_text_from_image_bytes(data)
-        if nl.endswith(".xlsx") or mime in ("application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",):
-            return extract_text_from_xlsx(data)
-        if any(nl.endswith(ext) for ext in _DEF_PLAIN_EXTS):
-            # プレーンテキストとして先頭だけ
-            return data.decode(errors="ignore")
+        return fn(data, max_chars)
     except Exception:
         return ""
-    return ""
 
 
-def ai_sort_files(service: Resource, parent_id: str, *, text_max: int=_DEF_TEXT_MAX, max_files: int=_DEF_MAX_FILES, max_bytes: int=_DEF_MAX_BYTES) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
-    """
-    - 親直下の子フォルダ名をカテゴリとして採用
-    - まずファイルタイトルだけで子フォルダ名と照合し、判定できれば即移動
-    - タイトルで判定できない場合にのみ: ダウンロード→OCR/抽出→AI分類→カテゴリ名と一致する子フォルダへ移動
-    - マッチしなければ skipped
-    - コスト制御: 件数上限、サイズ上限、テキスト長上限、結果キャッシュ(md5)
-    """
-    subfolders = list_subfolders(service, parent_id)
-    files = list_files_directly_under(service, parent_id)
+# (サブフォルダ一覧, プロファイル) → 照合用インデックス一式のキャッシュ。
+# ウォッチャーループや同じ親フォルダへの連続呼び出しで、辞書・オートマトン・
+# プロンプト断片の再構築を省く。値はサブフォルダ構成かルールJSONが変わると無効
+_folder_index_cache: Dict[Tuple[Tuple[str, str], ...], Tuple[Any, Tuple]] = {}
+_folder_index_lock = threading.Lock()
+_FOLDER_INDEX_MAX = 32
 
-    # カテゴリプロファイルをロード
-    profiles_by_name = load_category_profiles()
 
-    # 子フォルダの正規化辞書とタイトル照合用辞書
+def _folder_index(subfolders: List[Dict[str, Any]], profiles_by_name: Dict[str, Dict[str, Any]]) -> Tuple:
+    key = tuple((s["id"], s["name"]) for s in subfolders)
+    with _folder_index_lock:
+        hit = _folder_index_cache.get(key)
+        # load_category_profiles はmtimeキャッシュ済みオブジェクトを返すので、
+        # ルールJSONが変わっていないことは同一性比較だけで分かる
+        if hit is not None and hit[0] is profiles_by_name:
+            return hit[1]
+
     sub_by_norm: Dict[str, Dict[str, Any]] = {}
     sub_by_lower: Dict[str, Dict[str, Any]] = {}
     folder_profiles: List[Dict[str, Any]] = []
@@ -234,173 +689,369 @@ def ai_sort_files(service: Resource, parent_id: str, *, text_max: int=_DEF_TEXT_
             "include": base_profile.get("include", []),
             "exclude": base_profile.get("exclude", []),
         }
+        # 照合用の正規化はフォルダ毎に1回だけ。ファイル数に比例させない
+        folder_profile["_inc_norm"] = _norm_words(folder_profile["include"])
+        folder_profile["_exc_norm"] = _norm_words(folder_profile["exclude"])
         folder_profiles.append(folder_profile)
         sub_by_norm[_norm(s["name"])] = folder_profile
-        sub_by_lower[s["name"].lower()] = folder_profile
+        sub_by_lower[s["name"].casefold()] = folder_profile
 
-    cache = _load_cache()
+    # 候補フォルダのプロンプト断片は1回だけ組み立てて全呼び出しで共有する
+    profiles_prompt = render_profiles_prompt(folder_profiles) if folder_profiles else ""
+
+    # タイトル部分一致用のオートマトン（正規化名・小文字名それぞれ）
+    auto_norm = _build_name_automaton(sub_by_norm)
+    auto_lower = _build_name_automaton(sub_by_lower)
+    # ルールスコア用の include/exclude 一括マッチャ
+    rule_matcher = _build_rule_matcher(folder_profiles)
+    # _resolve_cat の部分一致用 3-gram インデックス
+    gram_index = _build_gram_index(sub_by_norm)
+
+    result = (folder_profiles, sub_by_norm, sub_by_lower,
+              auto_norm, auto_lower, rule_matcher, profiles_prompt, gram_index)
+    with _folder_index_lock:
+        if len(_folder_index_cache) >= _FOLDER_INDEX_MAX:
+            _folder_index_cache.pop(next(iter(_folder_index_cache)))
+        _folder_index_cache[key] = (profiles_by_name, result)
+    return result
+
+
+def ai_sort_files(service: Resource, parent_id: str, *, text_max: int=_DEF_TEXT_MAX, max_files: int=_DEF_MAX_FILES, max_bytes: int=_DEF_MAX_BYTES) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    - 親直下の子フォルダ名をカテゴリとして採用
+    - まずファイルタイトルだけで子フォルダ名と照合し、判定できれば即移動
+    - タイトルで判定できない場合にのみ: ダウンロード→OCR/抽出→AI分類→カテゴリ名と一致する子フォルダへ移動
+    - マッチしなければ skipped
+    - コスト制御: 件数上限、サイズ上限、テキスト長上限、結果キャッシュ(md5)
+    """
+    subfolders, files = _list_folder(service, parent_id, content_meta=True)
+
+    # カテゴリプロファイルをロード
+    profiles_by_name = load_category_profiles()
+
+    (folder_profiles, sub_by_norm, sub_by_lower,
+     auto_norm, auto_lower, rule_matcher, profiles_prompt,
+     (gram_index, gram_short_keys)) = _folder_index(subfolders, profiles_by_name)
 
-    moved: List[Dict[str, Any]] = []
     skipped: List[Dict[str, Any]] = []
+    planned: List[Tuple[Dict[str, Any], str, Dict[str, Any]]] = []
+
+    # AI呼び出し件数の上限はステージ/スレッド間で共有する
+    ai_budget = {"calls": 0}
+    budget_lock = threading.Lock()
+
+    def _take_ai_slot() -> bool:
+        with budget_lock:
+            if ai_budget["calls"] >= max_files:
+                return False
+            ai_budget["calls"] += 1
+            return True
+
+    def _resolve_cat(cat: str) -> Optional[Dict[str, Any]]:
+        """カテゴリ名を子フォルダへ解決（正規化して完全一致、なければ部分一致）。"""
+        norm_cat = _norm(cat or "")
+        if not norm_cat:
+            return None
+        dest = sub_by_norm.get(norm_cat)
+        if dest:
+            return dest
+        # 候補をgramインデックスで絞ってから実際の包含判定で確認する。
+        # 3文字以上なら、どちらの向きの包含でも共有する3-gramが必ず存在する
+        if len(norm_cat) < _GRAM_N:
+            for sub_norm, sub in sub_by_norm.items():
+                if sub_norm and (sub_norm in norm_cat or norm_cat in sub_norm):
+                    return sub
+            return None
+        candidates: set = set()
+        for i in range(len(norm_cat) - _GRAM_N + 1):
+            candidates |= gram_index.get(norm_cat[i:i + _GRAM_N], set())
+        for sub_norm in candidates:
+            if sub_norm in norm_cat or norm_cat in sub_norm:
+                return sub_by_norm[sub_norm]
+        for sub_norm in gram_short_keys:
+            if sub_norm in norm_cat or norm_cat in sub_norm:
+                return sub_by_norm[sub_norm]
+        return None
+
+    # ---- 1) タイトルだけで確定するものを先に仕分ける ----
+    needs_title_ai: List[Dict[str, Any]] = []
+    # (file, retry_title) — retry_title はバッチ分類に失敗して単発で再試行するもの
+    needs_content: List[Tuple[Dict[str, Any], bool]] = []
 
-    ai_calls = 0
     for f in files:
-        fid = f.get("id")
         fname = f.get("name", "")
-        mime = f.get("mimeType", "")
 
         dest_profile: Optional[Dict[str, Any]] = None
         method = ""
-        cat_method = ""
 
-        rule_profile = _best_profile_by_rules(fname, folder_profiles)
+        rule_profile = _best_profile_by_rules(fname, folder_profiles, matcher=rule_matcher)
         if rule_profile:
             dest_profile = rule_profile
             method = "title_rule"
 
-        title_norm = _norm(fname)
-        title_lower = fname.lower()
+        # ケース畳み込みはファイルにつき1回だけ。_norm 相当は畳んだ文字列から作る
+        title_cf = fname.casefold()
+        title_norm = title_cf.translate(_WS_DEL)
         if not dest_profile:
-            for sub_norm, sub in sub_by_norm.items():
-                if sub_norm and sub_norm in title_norm:
-                    dest_profile = sub
-                    method = "title_substring"
-                    break
+            hit = _first_name_hit(auto_norm, title_norm, sub_by_norm)
+            if hit:
+                dest_profile = hit
+                method = "title_substring"
         if not dest_profile:
-            for sub_lower, sub in sub_by_lower.items():
-                if sub_lower and sub_lower in title_lower:
-                    dest_profile = sub
-                    method = "title_substring"
-                    break
+            hit = _first_name_hit(auto_lower, title_cf, sub_by_lower)
+            if hit:
+                dest_profile = hit
+                method = "title_substring"
 
         if not dest_profile:
-            similar_profile = _best_profile_by_similarity(fname, folder_profiles)
+            similar_profile = _best_profile_by_similarity(title_cf, folder_profiles, pre_folded=True)
             if similar_profile:
                 dest_profile = similar_profile
                 method = "title_similarity"
 
-        if dest_profile:
-            try:
-                res = move_file(service, file_id=fid, dest_folder_id=dest_profile["id"])
-                moved.append({
-                    "file_id": res.get("id", fid),
-                    "name": res.get("name", fname),
-                    "to_folder": dest_profile["name"],
-                    "category": dest_profile["name"],
-                    "method": method or "title",
-                })
-                continue
-            except HttpError as e:
-                skipped.append({"file_id": fid, "name": fname, "reason": f"move_failed:{e}"})
+        if not dest_profile:
+            # 内容が同一のファイルはダウンロードもAIも踏まずにキャッシュで確定
+            md5 = f.get("md5Checksum")
+            cached_cat = _cache_get(md5) if md5 else None
+            if cached_cat == _CACHE_NOMATCH:
+                # 過去にAIが NONE と判定した内容。再分類してもコストの無駄
+                skipped.append({"file_id": f.get("id"), "name": fname, "reason": "cached_no_match"})
                 continue
+            if cached_cat:
+                hit = _resolve_cat(cached_cat)
+                if hit:
+                    dest_profile = hit
+                    method = "cache"
 
-        # タイトルだけでは決められない場合、GPTで近似カテゴリを確認
-        if folder_profiles:
-            if ai_calls >= max_files:
-                skipped.append({"file_id": fid, "name": fname, "reason": "ai_limit_reached"})
-                continue
+        if dest_profile:
+            planned.append((f, dest_profile["id"], {
+                "to_folder": dest_profile["name"],
+                "category": dest_profile["name"],
+                "method": method or "title",
+            }))
+        elif folder_profiles:
+            needs_title_ai.append(f)
+        else:
+            needs_content.append((f, False))
+
+    # ---- 2) タイトルAIは _TITLE_BATCH 件ずつ1リクエストにまとめる ----
+    for start in range(0, len(needs_title_ai), _TITLE_BATCH):
+        chunk = needs_title_ai[start:start + _TITLE_BATCH]
+        # バッチ全体でOpenAIへのリクエストは1回なので、予算も1枠だけ消費する
+        if not _take_ai_slot():
+            for f in chunk:
+                skipped.append({"file_id": f.get("id"), "name": f.get("name", ""), "reason": "ai_limit_reached"})
+            continue
+        try:
+            guesses = classify_titles_batch(
+                [f.get("name", "") for f in chunk], folder_profiles, joined=profiles_prompt
+            )
+        except Exception:
+            # バッチが壊れたらワーカー内で単発呼び出しに切り替える
+            needs_content.extend((f, True) for f in chunk)
+            continue
+        for f, guess in zip(chunk, guesses):
+            dest = _resolve_cat(guess) if guess and guess.upper() != "NONE" else None
+            if dest:
+                planned.append((f, dest["id"], {
+                    "to_folder": dest["name"],
+                    "category": dest["name"],
+                    "method": "title_ai",
+                    "ai_label": guess,
+                }))
+            else:
+                needs_content.append((f, False))
+
+    # ---- 3) 残りは内容ベース: ダウンロード→抽出→AI分類 ----
+    def _process(f: Dict[str, Any], retry_title: bool) -> Tuple[str, Any]:
+        """1ファイル分の (必要なら)タイトル再分類→ダウンロード→抽出→AI分類。
+
+        ("planned", (f, dest_id, extra)) か ("skipped", entry) を返す。
+        移動自体は最後に _execute_moves でまとめて行う。
+        """
+        fid = f.get("id")
+        fname = f.get("name", "")
+        mime = f.get("mimeType", "")
+        cat_method = ""
+
+        if retry_title and folder_profiles:
+            # バッチ失敗後の単発再試行も共有予算から1枠取る（ステージ2と同じ扱い）
+            if not _take_ai_slot():
+                return ("skipped", {"file_id": fid, "name": fname, "reason": "ai_limit_reached"})
             try:
-                title_guess = classify_title_with_ai(fname, folder_profiles)
-                ai_calls += 1
+                with _OPENAI_SEM:
+                    title_guess = classify_title_with_ai(fname, folder_profiles, joined=profiles_prompt)
             except Exception as e:
-                skipped.append({"file_id": fid, "name": fname, "reason": f"title_ai_failed:{e}"})
-                continue
+                return ("skipped", {"file_id": fid, "name": fname, "reason": f"title_ai_failed:{e}"})
             if title_guess and title_guess.upper() != "NONE":
-                norm_guess = _norm(title_guess)
-                dest = sub_by_norm.get(norm_guess)
-                if not dest:
-                    for sub_norm, sub in sub_by_norm.items():
-                        if sub_norm and (sub_norm in norm_guess or norm_guess in sub_norm):
-                            dest = sub
-                            break
+                dest = _resolve_cat(title_guess)
                 if dest:
-                    try:
-                        res = move_file(service, file_id=fid, dest_folder_id=dest["id"])
-                        moved.append({
-                            "file_id": res.get("id", fid),
-                            "name": res.get("name", fname),
-                            "to_folder": dest["name"],
-                            "category": dest["name"],
-                            "method": "title_ai",
-                            "ai_label": title_guess,
-                        })
-                        continue
-                    except HttpError as e:
-                        skipped.append({"file_id": fid, "name": fname, "reason": f"move_failed:{e}"})
-                        continue
-
-        # 追加メタ: size, md5
-        meta = service.files().get(fileId=fid, fields="size,md5Checksum").execute()
-        md5 = meta.get("md5Checksum")
-        size = int(meta.get("size", 0)) if meta.get("size") else 0
+                    return ("planned", (f, dest["id"], {
+                        "to_folder": dest["name"],
+                        "category": dest["name"],
+                        "method": "title_ai",
+                        "ai_label": title_guess,
+                    }))
+
+        # size/md5 は一覧取得時の fields に含めてあるので追加RTTは不要
+        md5 = f.get("md5Checksum")
+        size = int(f.get("size", 0)) if f.get("size") else 0
         if size and size > max_bytes:
-            skipped.append({"file_id": fid, "name": fname, "reason": f"too_large:{size}"})
-            continue
+            return ("skipped", {"file_id": fid, "name": fname, "reason": f"too_large:{size}"})
 
         # キャッシュ判定
-        cat: Optional[str] = cache.get(md5) if md5 else None
+        cat: Optional[str] = _cache_get(md5) if md5 else None
+        if cat == _CACHE_NOMATCH:
+            return ("skipped", {"file_id": fid, "name": fname, "reason": "cached_no_match"})
         if cat and not cat_method:
             cat_method = "cache"
         text = ""
         if not cat:
-            if ai_calls >= max_files:
-                skipped.append({"file_id": fid, "name": fname, "reason": "ai_limit_reached"})
-                continue
+            # 予算はOpenAIリクエストを発行する箇所（ステージ4）で消費する。
+            # ルールやキャッシュで確定するファイルはAIを呼ばないので課金しない
+            # プレーンテキストは抽出が先頭 text_max*4 文字しか見ないので、
+            # Range も最初からそのバイト数だけ要求する（巨大ログで特に効く）
+            plain = os.path.splitext(fname)[1].lower() in _DEF_PLAIN_EXTS
+            head_bytes = min(_HEAD_BYTES, text_max * 4) if plain else _HEAD_BYTES
             try:
-                data = _download_bytes(service, fid)
+                with _DOWNLOAD_SEM:
+                    data = _download_range(service, fid, max_bytes=head_bytes, http=_local_http(service))
+                    if data is None:
+                        data = _download_bytes(service, fid, http=_local_http(service))
             except Exception as e:
-                skipped.append({"file_id": fid, "name": fname, "reason": f"download_failed:{e}"})
-                continue
-            text = _extract_text(fname, mime, data)[:text_max]
-            if text:
-                text_profile = _best_profile_by_rules(text, folder_profiles)
-                if text_profile:
-                    cat = text_profile["name"]
-                    cat_method = "content_rule"
-                else:
+                return ("skipped", {"file_id": fid, "name": fname, "reason": f"download_failed:{e}"})
+            if not md5:
+                # Googleドキュメント等でDriveがチェックサムを返さない場合も、
+                # 取得した先頭バイト列から自前で計算してキャッシュを効かせる
+                md5 = hashlib.md5(data).hexdigest()
+                cached = _cache_get(md5)
+                if cached == _CACHE_NOMATCH:
+                    return ("skipped", {"file_id": fid, "name": fname, "reason": "cached_no_match"})
+                if cached:
+                    cat = cached
+                    cat_method = "cache"
+            if not cat:
+                # 打ち切り余裕をみて text_max の4倍まで読めば分類には十分
+                text = _clip_utf8(_extract_text(fname, mime, data, max_chars=text_max * 4), text_max)
+                if not text and len(data) >= head_bytes:
+                    # 先頭だけでは解釈できない形式（xlsx等は末尾が要る）→ 全量で再試行。
+                    # プレーンテキストなら text_max*4 文字ぶん読めれば十分なので打ち切る
                     try:
-                        cat = classify_with_ai(fname, text, folder_profiles)
-                        ai_calls += 1
-                        cat_method = "content_ai"
+                        with _DOWNLOAD_SEM:
+                            data = _download_bytes(
+                                service, fid, http=_local_http(service),
+                                max_bytes=text_max * 4 if plain else None,
+                            )
                     except Exception as e:
-                        skipped.append({"file_id": fid, "name": fname, "reason": f"ai_failed:{e}"})
-                        continue
-            if md5 and cat and cat.upper() != "NONE":
-                cache[md5] = cat
+                        return ("skipped", {"file_id": fid, "name": fname, "reason": f"download_failed:{e}"})
+                    text = _clip_utf8(_extract_text(fname, mime, data, max_chars=text_max * 4), text_max)
+                if text:
+                    text_profile = _best_profile_by_rules(text, folder_profiles, matcher=rule_matcher)
+                    if text_profile:
+                        cat = text_profile["name"]
+                        cat_method = "content_rule"
+                    else:
+                        # 内容AIはバッチにまとめるため、ここでは呼ばずに持ち帰る
+                        return ("needs_ai", (f, text, md5))
+                if md5 and cat:
+                    # NONE もネガティブキャッシュとして残し、同一内容の再OCR/再AIを防ぐ
+                    _cache_put(md5, _CACHE_NOMATCH if cat.upper() == "NONE" else cat)
 
         if cat and cat.upper() == "NONE":
-            skipped.append({"file_id": fid, "name": fname, "reason": "ai_returned_none"})
-            continue
+            return ("skipped", {"file_id": fid, "name": fname, "reason": "ai_returned_none"})
 
-        # マッチング（正規化して完全一致、なければ部分一致）
-        norm_cat = _norm(cat or "")
-        dest = None
-        if norm_cat in sub_by_norm:
-            dest = sub_by_norm[norm_cat]
-        else:
-            for sub_norm, sub in sub_by_norm.items():
-                if sub_norm and (sub_norm in norm_cat or norm_cat in sub_norm):
-                    dest = sub
-                    break
+        dest = _resolve_cat(cat or "")
+        if not dest:
+            return ("skipped", {"file_id": fid, "name": fname, "reason": f"no_match:{cat}"})
+
+        entry = {
+            "to_folder": dest["name"],
+            "category": cat,
+            "method": cat_method or "content",
+        }
+        if cat_method in {"content_ai", "cache"}:
+            entry["ai_label"] = cat
+        return ("planned", (f, dest["id"], entry))
 
+    def _record_content_result(f: Dict[str, Any], cat: str, md5: Optional[str]):
+        """内容AIの分類結果をキャッシュし、planned/skipped に振り分ける。"""
+        fid = f.get("id")
+        fname = f.get("name", "")
+        if md5 and cat:
+            _cache_put(md5, _CACHE_NOMATCH if cat.upper() == "NONE" else cat)
+        if not cat or cat.upper() == "NONE":
+            skipped.append({"file_id": fid, "name": fname, "reason": "ai_returned_none"})
+            return
+        dest = _resolve_cat(cat)
         if not dest:
             skipped.append({"file_id": fid, "name": fname, "reason": f"no_match:{cat}"})
-            continue
+            return
+        planned.append((f, dest["id"], {
+            "to_folder": dest["name"],
+            "category": cat,
+            "method": "content_ai",
+            "ai_label": cat,
+        }))
+
+    # ダウンロード/OCR/LLM はすべてI/O待ちが支配的なので、ファイル単位で並列化する
+    needs_ai: List[Tuple[Dict[str, Any], str, Optional[str]]] = []
+    if needs_content:
+        with ThreadPoolExecutor(max_workers=_AI_WORKERS) as pool:
+            futures = {pool.submit(_process, f, retry): f for f, retry in needs_content}
+            for fut in as_completed(futures):
+                f = futures[fut]
+                try:
+                    kind, payload = fut.result()
+                except Exception as e:  # 個々のファイルの失敗は巻き込まない
+                    skipped.append({"file_id": f.get("id"), "name": f.get("name", ""), "reason": f"worker_failed:{e}"})
+                    continue
+                if kind == "planned":
+                    planned.append(payload)
+                elif kind == "needs_ai":
+                    needs_ai.append(payload)
+                else:
+                    skipped.append(payload)
 
+    # ---- 4) 内容AIも _CONTENT_BATCH 件ずつ1リクエストにまとめる ----
+    if needs_ai and not folder_profiles:
+        # 候補プロファイルが無いとバッチ分類は空リストを返すだけなので、
+        # ここで全件を結果記録に回して moved/skipped から漏れないようにする
+        for f, _text, md5 in needs_ai:
+            _record_content_result(f, "", md5)
+        needs_ai = []
+    for start in range(0, len(needs_ai), _CONTENT_BATCH):
+        chunk = needs_ai[start:start + _CONTENT_BATCH]
+        # バッチ全体でOpenAIへのリクエストは1回なので、予算も1枠だけ消費する
+        if not _take_ai_slot():
+            for f, _text, _md5 in chunk:
+                skipped.append({"file_id": f.get("id"), "name": f.get("name", ""), "reason": "ai_limit_reached"})
+            continue
         try:
-            res = move_file(service, file_id=fid, dest_folder_id=dest["id"])
-            entry = {
-                "file_id": res.get("id", fid),
-                "name": res.get("name", fname),
-                "to_folder": dest["name"],
-                "category": cat,
-                "method": cat_method or "content",
-            }
-            if cat_method in {"content_ai", "cache"}:
-                entry["ai_label"] = cat
-            moved.append(entry)
-        except HttpError as e:
-            skipped.append({"file_id": fid, "name": fname, "reason": f"move_failed:{e}"})
-
-    _save_cache(cache)
+            with _OPENAI_SEM:
+                cats = classify_batch_with_ai(
+                    [(f.get("name", ""), text) for f, text, _ in chunk],
+                    folder_profiles, joined=profiles_prompt,
+                )
+        except Exception:
+            # バッチが壊れたら単発呼び出しにフォールバック
+            cats = None
+        if cats is None:
+            for f, text, md5 in chunk:
+                # 単発フォールバックも1呼び出し=1枠（ステージ2の再試行と同じ扱い）
+                if not _take_ai_slot():
+                    skipped.append({"file_id": f.get("id"), "name": f.get("name", ""), "reason": "ai_limit_reached"})
+                    continue
+                try:
+                    with _OPENAI_SEM:
+                        cat = classify_with_ai(f.get("name", ""), text, folder_profiles, joined=profiles_prompt)
+                except Exception as e:
+                    skipped.append({"file_id": f.get("id"), "name": f.get("name", ""), "reason": f"ai_failed:{e}"})
+                    continue
+                _record_content_result(f, cat, md5)
+        else:
+            for (f, text, md5), cat in zip(chunk, cats):
+                _record_content_result(f, cat, md5)
+
+    moved, move_skipped = _execute_moves(service, planned)
+    skipped.extend(move_skipped)
     return moved, skipped